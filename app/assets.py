@@ -0,0 +1,137 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from jinja2 import pass_context
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+IMMUTABLE = b'public, max-age=31536000, immutable'
+REVALIDATE = b'no-cache'
+
+
+class Asset:
+    def __init__(self, path, content):
+        digest = hashlib.sha256(content).hexdigest()
+        root, ext = os.path.splitext(path)
+        self.path = path
+        self.hashed_path = '{}.{}{}'.format(root, digest[:10], ext)
+        self.media_type = (mimetypes.guess_type(path)[0] or 'application/octet-stream').encode('ascii')
+        # Each encoding is a different byte sequence, so each gets its own
+        # strong ETag.
+        etag = digest[:32]
+        self.variants = {'identity': (content, '"{}"'.format(etag).encode('ascii'))}
+        # Only keep an encoding when it actually saves bytes; PNGs rarely do.
+        limit = len(content) * 0.9
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < limit:
+            self.variants['gzip'] = (compressed, '"{}-gz"'.format(etag).encode('ascii'))
+        if brotli is not None:
+            compressed = brotli.compress(content)
+            if len(compressed) < limit:
+                self.variants['br'] = (compressed, '"{}-br"'.format(etag).encode('ascii'))
+        self.etags = {tag for _, tag in self.variants.values()}
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:].rstrip('0.') == '':
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class StaticAssets:
+    """Serve ``directory`` from memory with content-hashed URLs.
+
+    Every file is read, hashed and precompressed once when the app starts.
+    Hashed URLs (``css/style.<hash>.css``) are cached forever by browsers;
+    the plain paths still work but must be revalidated.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.assets = {}
+        self.hashed = {}
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                path = os.path.relpath(full_path, directory).replace(os.sep, '/')
+                with open(full_path, 'rb') as f:
+                    asset = Asset(path, f.read())
+                self.assets[path] = asset
+                self.hashed[asset.hashed_path] = asset
+
+    def url_path(self, path):
+        asset = self.assets.get(path.lstrip('/'))
+        return asset.hashed_path if asset is not None else path
+
+    def install(self, templates):
+        """Make ``url_for('static', path=...)`` in ``templates`` emit hashed URLs."""
+        @pass_context
+        def url_for(context, name, **path_params):
+            if name == 'static' and 'path' in path_params:
+                path_params['path'] = self.url_path(path_params['path'])
+            return context['request'].url_for(name, **path_params)
+
+        templates.env.globals['url_for'] = url_for
+
+    async def __call__(self, scope, receive, send):
+        assert scope['type'] == 'http'
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self.respond(send, 405, [(b'allow', b'GET, HEAD')])
+            return
+
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        # Newer Starlette keeps the mount prefix in ``path``, older strips it.
+        if root_path and path.startswith(root_path + '/'):
+            path = path[len(root_path):]
+        path = path.lstrip('/')
+        asset = self.hashed.get(path)
+        cache_control = IMMUTABLE
+        if asset is None:
+            asset = self.assets.get(path)
+            cache_control = REVALIDATE
+        if asset is None:
+            await self.respond(send, 404, [], b'Not Found')
+            return
+
+        request_headers = dict(scope['headers'])
+        headers = [(b'cache-control', cache_control), (b'vary', b'Accept-Encoding')]
+        if_none_match = request_headers.get(b'if-none-match')
+        if if_none_match is not None:
+            for tag in if_none_match.split(b','):
+                tag = tag.strip()
+                if tag in asset.etags:
+                    headers.append((b'etag', tag))
+                    await self.respond(send, 304, headers)
+                    return
+
+        encoding = 'identity'
+        if len(asset.variants) > 1:
+            accepted = accepted_encodings(request_headers.get(b'accept-encoding', b'').decode('latin-1'))
+            for name in ('br', 'gzip'):
+                if name in asset.variants and name in accepted:
+                    encoding = name
+                    break
+        body, etag = asset.variants[encoding]
+        headers.append((b'etag', etag))
+        headers.append((b'content-type', asset.media_type))
+        if encoding != 'identity':
+            headers.append((b'content-encoding', encoding.encode('ascii')))
+        await self.respond(send, 200, headers, body, scope['method'] == 'HEAD')
+
+    @staticmethod
+    async def respond(send, status, headers, body=b'', head=False):
+        if status != 304:
+            headers.append((b'content-length', str(len(body)).encode('ascii')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if head else body})
@@ -0,0 +1,252 @@
+"""Login, logout and sign-in error events, written off the request path.
+
+Handlers call ``AuditLog.record()``, which only appends to an in-memory
+queue. A background task drains the queue every ``flush_interval`` seconds
+and hands each batch to a sink in a worker thread, so a slow disk never
+holds up a login. The queue is bounded; when it is full the ``overflow``
+policy decides whether the oldest queued event or the new one is dropped,
+and drops are counted in ``audit_events_dropped_total``. Whatever is still
+queued at shutdown is flushed before the sink is closed.
+
+Recent events can be read back with ``recent()``, or from a shell::
+
+    python -m app.audit --email user@example.com
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+events_total = metrics.registry.register(metrics.Counter(
+    'audit_events_total', 'Audit events recorded, by kind.', ('kind',)))
+dropped_total = metrics.registry.register(metrics.Counter(
+    'audit_events_dropped_total', 'Audit events dropped because the queue was full or the sink failed.'))
+
+
+def client_details(request):
+    return {
+        'ip': request.client.host if request.client else None,
+        'user_agent': request.headers.get('user-agent'),
+    }
+
+
+class SQLiteSink:
+    """Events in an SQLite table indexed by email and by time."""
+
+    def __init__(self, path='audit.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        db = self._connect()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS events ('
+            ' id INTEGER PRIMARY KEY, at REAL NOT NULL, kind TEXT NOT NULL,'
+            ' email TEXT, sub TEXT, detail TEXT NOT NULL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS events_email_at ON events (email, at)')
+        db.execute('CREATE INDEX IF NOT EXISTS events_at ON events (at)')
+        db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    @property
+    def _db(self):
+        if self._pid != os.getpid():
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def write(self, events):
+        rows = []
+        for event in events:
+            detail = dict(event)
+            rows.append((detail.pop('at'), detail.pop('kind'), detail.pop('email', None),
+                         detail.pop('sub', None), json.dumps(detail)))
+        with self._lock:
+            db = self._db
+            db.execute('BEGIN')
+            try:
+                db.executemany(
+                    'INSERT INTO events (at, kind, email, sub, detail) VALUES (?, ?, ?, ?, ?)', rows)
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def recent(self, email=None, kind=None, limit=20):
+        query = 'SELECT at, kind, email, sub, detail FROM events'
+        where, params = [], []
+        if email is not None:
+            where.append('email = ?')
+            params.append(email)
+        if kind is not None:
+            where.append('kind = ?')
+            params.append(kind)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY at DESC LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        events = []
+        for at, kind, email, sub, detail in rows:
+            event = {'at': at, 'kind': kind, 'email': email, 'sub': sub}
+            event.update(json.loads(detail))
+            events.append(event)
+        return events
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+            self._pid = None
+
+
+class JSONLSink:
+    """Events appended to a file, one JSON object per line.
+
+    Easy to ship to a log pipeline, but ``recent()`` has to scan the whole
+    file; use the SQLite sink when events are queried here.
+    """
+
+    def __init__(self, path='audit.jsonl'):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, events):
+        lines = ''.join(json.dumps(event) + '\n' for event in events)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def recent(self, email=None, kind=None, limit=20):
+        matches = collections.deque(maxlen=limit)
+        try:
+            with self._lock, open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    event = json.loads(line)
+                    if (email is None or event.get('email') == email) and \
+                            (kind is None or event['kind'] == kind):
+                        matches.append(event)
+        except FileNotFoundError:
+            pass
+        return sorted(matches, key=lambda event: event['at'], reverse=True)
+
+    def close(self):
+        pass
+
+
+class AuditLog:
+    """Bounded in-memory queue in front of a sink, drained by a background task.
+
+    ``overflow`` is ``'drop-oldest'`` or ``'drop-newest'``; ``record()``
+    never waits for room, so a stuck sink costs events rather than logins.
+    """
+
+    def __init__(self, sink, max_queue=10000, batch_size=500, flush_interval=1.0,
+                 overflow='drop-oldest'):
+        if overflow not in ('drop-oldest', 'drop-newest'):
+            raise ValueError('overflow must be drop-oldest or drop-newest')
+        self.sink = sink
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self._queue = collections.deque()
+        self._task = None
+        self._stopping = None
+
+    def record(self, kind, **fields):
+        """Queue an event; returns False when it was dropped."""
+        event = {'at': time.time(), 'kind': kind}
+        event.update(fields)
+        events_total.inc(kind)
+        if len(self._queue) >= self.max_queue:
+            dropped_total.inc()
+            if self.overflow == 'drop-newest':
+                return False
+            try:
+                self._queue.popleft()
+            except IndexError:
+                pass
+        # deque.append is atomic, so sync handlers in the threadpool can call this too.
+        self._queue.append(event)
+        return True
+
+    def __len__(self):
+        return len(self._queue)
+
+    def recent(self, email=None, kind=None, limit=20):
+        return self.sink.recent(email=email, kind=kind, limit=limit)
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        while self._queue:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            try:
+                with metrics.stage('audit_write'):
+                    await asyncio.to_thread(self.sink.write, batch)
+            except Exception:
+                log.warning('Could not write %d audit events', len(batch), exc_info=True)
+                # Put them back for the next flush, as far as there is room.
+                keep = max(0, min(len(batch), self.max_queue - len(self._queue)))
+                for _ in range(len(batch) - keep):
+                    dropped_total.inc()
+                self._queue.extendleft(reversed(batch[len(batch) - keep:]))
+                return
+
+    async def close(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        self.sink.close()
+
+
+def open_sink(kind, path):
+    if kind == 'jsonl':
+        return JSONLSink(path)
+    return SQLiteSink(path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .config import AUDIT_SINK, AUDIT_PATH
+
+    parser = argparse.ArgumentParser(description='Show recent audit events.')
+    parser.add_argument('--email')
+    parser.add_argument('--kind', choices=('login', 'logout', 'error'))
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+    sink = open_sink(AUDIT_SINK, AUDIT_PATH)
+    for event in sink.recent(email=args.email, kind=args.kind, limit=args.limit):
+        print(json.dumps(event))
@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+
+import httpx
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from .outbound import ssl_context
+
+# Pillow is only imported by the first thumbnail; without it avatars are
+# cached at the size upstream sends.
+HAVE_PILLOW = importlib.util.find_spec('PIL') is not None
+
+log = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    'image/webp': '.webp',
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+}
+MEDIA_TYPES = {ext: media_type for media_type, ext in EXTENSIONS.items()}
+GOOGLE_SIZE_RE = re.compile(r'=s\d+(-c)?$')
+
+
+def sized_url(url, size):
+    """Ask googleusercontent for the size we render instead of its 96px default."""
+    if 'googleusercontent.com' in url:
+        if GOOGLE_SIZE_RE.search(url):
+            return GOOGLE_SIZE_RE.sub('=s{}-c'.format(size), url)
+        return '{}=s{}-c'.format(url, size)
+    return url
+
+
+def thumbnail(content, size):
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(content)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format='WEBP', quality=85, method=4)
+    return out.getvalue(), 'image/webp'
+
+
+class AvatarCache:
+    """Profile pictures fetched once, thumbnailed and kept on disk.
+
+    The disk cache is bounded by ``max_bytes`` and evicts the least recently
+    served file first, going by mtime. Every hit, including a 304, bumps
+    the file's mtime; repeat hits skip it for ``touch_interval`` seconds
+    unless this worker stored a file since, which may trigger eviction. The
+    directory is shared by every worker, so the bound is enforced from its
+    contents: each new file triggers a rescan, and
+    pictures another worker stored or evicted are picked up from disk. When
+    the upstream fetch fails the bundled default avatar is served instead,
+    and the same picture is not retried for ``failure_ttl`` seconds.
+    """
+
+    def __init__(self, directory, fallback_path, size=140, max_bytes=50 * 1024 * 1024,
+                 max_image_bytes=2 * 1024 * 1024, timeout=5.0, max_connections=20,
+                 failure_ttl=60, max_age=3600, touch_interval=10):
+        self.directory = directory
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.failure_ttl = failure_ttl
+        self.touch_interval = touch_interval
+        self.cache_control = 'private, max-age={}'.format(max_age)
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            verify=ssl_context(),
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+        )
+        with open(fallback_path, 'rb') as f:
+            self.fallback = f.read()
+        self.fallback_etag = '"{}"'.format(hashlib.sha256(self.fallback).hexdigest()[:32])
+        self._failures = {}
+        self._pending = {}
+        self._touched = {}
+        self._stored = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index, self._total = self._scan()
+
+    def _scan(self):
+        """The files in the cache directory, least recently served first."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            key, ext = os.path.splitext(filename)
+            if ext not in MEDIA_TYPES:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                # Evicted by another worker while we were listing.
+                continue
+            entries.append((stat.st_mtime, key, filename, stat.st_size))
+        index = OrderedDict()
+        total = 0
+        for _, key, filename, size in sorted(entries):
+            index[key] = (filename, size)
+            total += size
+        return index, total
+
+    def key(self, url):
+        return hashlib.sha256('{}\n{}'.format(self.size, url).encode('utf-8')).hexdigest()[:32]
+
+    async def response(self, request, url):
+        key = self.key(url)
+        entry = self._index.get(key)
+        if entry is None:
+            entry = await self._fill(key, url)
+            if entry is None:
+                return self.fallback_response(request)
+        filename, _ = entry
+        etag = '"{}"'.format(key)
+        if self._not_modified(request, etag):
+            await self._touch(key, filename)
+            return Response(status_code=304, headers={'etag': etag, 'cache-control': self.cache_control})
+        try:
+            body = await run_in_threadpool(self._read, filename)
+            self._touched[key] = (time.monotonic(), self._stored)
+        except OSError:
+            # Another worker evicted it; fetch it again.
+            self._forget(key)
+            entry = await self._fill(key, url)
+            if entry is None:
+                return self.fallback_response(request)
+            filename, _ = entry
+            try:
+                body = await run_in_threadpool(self._read, filename)
+            except OSError:
+                return self.fallback_response(request)
+        media_type = MEDIA_TYPES[os.path.splitext(filename)[1]]
+        return Response(body, media_type=media_type,
+                        headers={'etag': etag, 'cache-control': self.cache_control})
+
+    def fallback_response(self, request):
+        headers = {'etag': self.fallback_etag, 'cache-control': 'no-cache'}
+        if self._not_modified(request, self.fallback_etag):
+            return Response(status_code=304, headers=headers)
+        return Response(self.fallback, media_type='image/png', headers=headers)
+
+    @staticmethod
+    def _not_modified(request, etag):
+        if_none_match = request.headers.get('if-none-match')
+        return bool(if_none_match) and etag in [tag.strip() for tag in if_none_match.split(',')]
+
+    async def _fill(self, key, url):
+        failed_at = self._failures.get(key)
+        if failed_at is not None and time.monotonic() - failed_at < self.failure_ttl:
+            return None
+        # Concurrent requests for the same picture share one upstream fetch.
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(self._download(key, url))
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, key, url):
+        entry = await run_in_threadpool(self._find, key)
+        if entry is not None:
+            self._index[key] = entry
+            self._total += entry[1]
+            return entry
+        try:
+            content, media_type = await self._get(sized_url(url, self.size))
+            entry = await run_in_threadpool(self._store, key, content, media_type)
+        except Exception as e:
+            log.warning('Could not fetch avatar %s: %r', url, e)
+            self._failures[key] = time.monotonic()
+            return None
+        self._failures.pop(key, None)
+        self._stored += 1
+        self._index, self._total = await run_in_threadpool(self._evict)
+        self._touched = {k: t for k, t in self._touched.items() if k in self._index}
+        return entry
+
+    async def _get(self, url):
+        async with self.client.stream('GET', url) as resp:
+            resp.raise_for_status()
+            media_type = resp.headers.get('content-type', '').split(';')[0].strip()
+            if media_type not in EXTENSIONS:
+                raise ValueError('Unsupported avatar type {!r}'.format(media_type))
+            chunks = []
+            total = 0
+            async for chunk in resp.aiter_bytes():
+                total += len(chunk)
+                if total > self.max_image_bytes:
+                    raise ValueError('Avatar larger than {} bytes'.format(self.max_image_bytes))
+                chunks.append(chunk)
+        return b''.join(chunks), media_type
+
+    def _store(self, key, content, media_type):
+        if HAVE_PILLOW:
+            content, media_type = thumbnail(content, self.size)
+        filename = key + EXTENSIONS[media_type]
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, os.path.join(self.directory, filename))
+        return filename, len(content)
+
+    def _find(self, key):
+        for ext in MEDIA_TYPES:
+            filename = key + ext
+            try:
+                size = os.stat(os.path.join(self.directory, filename)).st_size
+            except FileNotFoundError:
+                continue
+            return filename, size
+        return None
+
+    def _read(self, filename):
+        path = os.path.join(self.directory, filename)
+        with open(path, 'rb') as f:
+            body = f.read()
+        # mtime is the LRU order eviction goes by, across workers and restarts.
+        os.utime(path)
+        return body
+
+    async def _touch(self, key, filename):
+        now = time.monotonic()
+        touched_at, stored = self._touched.get(key, (float('-inf'), None))
+        if stored == self._stored and now - touched_at < self.touch_interval:
+            return
+        self._touched[key] = (now, self._stored)
+        try:
+            await run_in_threadpool(os.utime, os.path.join(self.directory, filename))
+        except OSError:
+            self._forget(key)
+
+    def _forget(self, key):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._total -= entry[1]
+
+    def _evict(self):
+        index, total = self._scan()
+        while total > self.max_bytes and len(index) > 1:
+            key, (filename, size) = index.popitem(last=False)
+            total -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+        return index, total
+
+    async def close(self):
+        await self.client.aclose()
+
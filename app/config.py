@@ -5,3 +5,78 @@ load_dotenv()
 
 CLIENT_ID = os.environ.get('client-id',None)
 CLIENT_SECRET = os.environ.get('client-secret',None)
+
+OIDC_METADATA_URL = os.environ.get(
+    'oidc-metadata-url', 'https://accounts.google.com/.well-known/openid-configuration')
+OIDC_METADATA_TTL = int(os.environ.get('oidc-metadata-ttl', 3600))
+OIDC_JWKS_TTL = int(os.environ.get('oidc-jwks-ttl', 3600))
+
+DEFAULT_SESSION_SECRET = 'add any string...'
+SESSION_SECRET = os.environ.get('session-secret', DEFAULT_SESSION_SECRET)
+# memory, sqlite or cookie (the old signed-cookie SessionMiddleware)
+SESSION_BACKEND = os.environ.get('session-backend', 'memory')
+SESSION_DB = os.environ.get('session-db', 'sessions.db')
+SESSION_MAX_AGE = int(os.environ.get('session-max-age', 14 * 24 * 60 * 60))
+
+AVATAR_CACHE_DIR = os.environ.get('avatar-cache-dir', 'cache/avatars')
+AVATAR_CACHE_BYTES = int(os.environ.get('avatar-cache-bytes', 50 * 1024 * 1024))
+# .img-pic is rendered at 70px, thumbnails are made for 2x screens
+AVATAR_SIZE = int(os.environ.get('avatar-size', 140))
+
+PAGE_CACHE = os.environ.get('page-cache', '1') not in ('0', 'false', 'no')
+TEMPLATE_CACHE_DIR = os.environ.get('template-cache-dir', 'cache/jinja')
+
+OAUTH_POOL_SIZE = int(os.environ.get('oauth-pool-size', 20))
+OAUTH_MAX_CONCURRENCY = int(os.environ.get('oauth-max-concurrency', 20))
+OAUTH_QUEUE_TIMEOUT = float(os.environ.get('oauth-queue-timeout', 2.0))
+OAUTH_CONNECT_TIMEOUT = float(os.environ.get('oauth-connect-timeout', 3.0))
+OAUTH_READ_TIMEOUT = float(os.environ.get('oauth-read-timeout', 5.0))
+OAUTH_BREAKER_FAILURES = int(os.environ.get('oauth-breaker-failures', 5))
+OAUTH_BREAKER_RESET = float(os.environ.get('oauth-breaker-reset', 30))
+
+# Dump a stack profile for requests slower than this; 0 turns the profiler off
+PROFILE_SLOW_MS = int(os.environ.get('profile-slow-ms', 0))
+PROFILE_DIR = os.environ.get('profile-dir', 'profiles')
+
+# sqlite, jsonl or off; login/logout/error events are written in batches
+AUDIT_SINK = os.environ.get('audit-sink', 'sqlite')
+AUDIT_PATH = os.environ.get('audit-path', 'audit.jsonl' if AUDIT_SINK == 'jsonl' else 'audit.db')
+AUDIT_QUEUE_SIZE = int(os.environ.get('audit-queue-size', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('audit-batch-size', 500))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('audit-flush-interval', 1.0))
+# what to drop when the queue is full: drop-oldest or drop-newest
+AUDIT_OVERFLOW = os.environ.get('audit-overflow', 'drop-oldest')
+
+# development runs a single reloading process, production the pre-fork server
+APP_ENV = os.environ.get('app-env', 'development')
+PRODUCTION = APP_ENV == 'production'
+SERVER_HOST = os.environ.get('server-host', '0.0.0.0' if PRODUCTION else 'localhost')
+SERVER_PORT = int(os.environ.get('server-port', 8000))
+SERVER_WORKERS = int(os.environ.get('server-workers', os.cpu_count() or 1))
+# auto picks uvloop and httptools when they are installed
+SERVER_LOOP = os.environ.get('server-loop', 'auto')
+SERVER_HTTP = os.environ.get('server-http', 'auto')
+SERVER_GRACEFUL_TIMEOUT = float(os.environ.get('server-graceful-timeout', 30))
+FORWARDED_ALLOW_IPS = os.environ.get('forwarded-allow-ips', '127.0.0.1')
+
+
+def problems():
+    """Configuration errors that should stop the server from starting."""
+    errors = []
+    if not CLIENT_ID or not CLIENT_SECRET:
+        errors.append('client-id and client-secret must be set')
+    if SERVER_WORKERS < 1:
+        errors.append('server-workers must be at least 1')
+    if SESSION_BACKEND not in ('memory', 'sqlite', 'cookie'):
+        errors.append('session-backend must be memory, sqlite or cookie')
+    if AUDIT_SINK not in ('sqlite', 'jsonl', 'off'):
+        errors.append('audit-sink must be sqlite, jsonl or off')
+    if AUDIT_OVERFLOW not in ('drop-oldest', 'drop-newest'):
+        errors.append('audit-overflow must be drop-oldest or drop-newest')
+    if PRODUCTION:
+        if SESSION_SECRET == DEFAULT_SESSION_SECRET or len(SESSION_SECRET) < 32:
+            errors.append('session-secret must be a random string of at least 32 characters')
+        if SERVER_WORKERS > 1 and SESSION_BACKEND == 'memory':
+            errors.append('session-backend=memory cannot be shared by {} workers; '
+                          'use sqlite or cookie'.format(SERVER_WORKERS))
+    return errors
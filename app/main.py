@@ -73,33 +73,126 @@
 #     return RedirectResponse('/')
 
 
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import FastAPI
 from fastapi.templating import Jinja2Templates
 from starlette.requests import Request
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, PlainTextResponse
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth, OAuthError
-from .config import CLIENT_ID, CLIENT_SECRET
-from fastapi.staticfiles import StaticFiles
+from .config import CLIENT_ID, CLIENT_SECRET, OIDC_METADATA_URL, OIDC_METADATA_TTL, OIDC_JWKS_TTL
+from .config import SESSION_SECRET, SESSION_BACKEND, SESSION_DB, SESSION_MAX_AGE
+from .config import AVATAR_CACHE_DIR, AVATAR_CACHE_BYTES, AVATAR_SIZE
+from .config import PAGE_CACHE, TEMPLATE_CACHE_DIR
+from .config import (OAUTH_POOL_SIZE, OAUTH_MAX_CONCURRENCY, OAUTH_QUEUE_TIMEOUT,
+                     OAUTH_CONNECT_TIMEOUT, OAUTH_READ_TIMEOUT,
+                     OAUTH_BREAKER_FAILURES, OAUTH_BREAKER_RESET)
+from .config import PROFILE_SLOW_MS, PROFILE_DIR
+from .config import (AUDIT_SINK, AUDIT_PATH, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE,
+                     AUDIT_FLUSH_INTERVAL, AUDIT_OVERFLOW)
+from .oidc import CachedOAuth2App
+from .outbound import CircuitBreaker, GuardedTransport
+from .sessions import ServerSessionMiddleware, MemoryStore, SQLiteStore
+from .assets import StaticAssets
+from .avatars import AvatarCache
+from .pages import PageCache
+from . import audit as audit_log
+from . import metrics
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if profiler is not None:
+        profiler.start()
+    if audit is not None:
+        audit.start()
+    await oauth.google.warm_up()
+    yield
+    if profiler is not None:
+        profiler.stop()
+    if audit is not None:
+        await audit.close()
+    await oauth.google.close()
+    await oauth_transport.close()
+    await avatars.close()
+    if session_store is not None:
+        session_store.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+session_store = None
+if SESSION_BACKEND == 'cookie':
+    app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET, max_age=SESSION_MAX_AGE)
+else:
+    if SESSION_BACKEND == 'sqlite':
+        session_store = SQLiteStore(SESSION_DB, max_age=SESSION_MAX_AGE)
+    else:
+        session_store = MemoryStore(max_age=SESSION_MAX_AGE)
+    app.add_middleware(ServerSessionMiddleware, store=session_store, secret_key=SESSION_SECRET)
 
-app = FastAPI()
-app.add_middleware(SessionMiddleware, secret_key="add any string...")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+profiler = None
+if PROFILE_SLOW_MS:
+    profiler = metrics.SlowRequestProfiler(PROFILE_DIR, threshold=PROFILE_SLOW_MS / 1000)
+app.add_middleware(metrics.MetricsMiddleware, profiler=profiler)
+
+static_assets = StaticAssets("static")
+app.mount("/static", static_assets, name="static")
+
+oauth_transport = GuardedTransport(
+    pool_size=OAUTH_POOL_SIZE,
+    max_concurrency=OAUTH_MAX_CONCURRENCY,
+    queue_timeout=OAUTH_QUEUE_TIMEOUT,
+    breaker=CircuitBreaker(OAUTH_BREAKER_FAILURES, OAUTH_BREAKER_RESET),
+    observer=metrics.observe_outbound,
+)
+metrics.registry.register(metrics.Gauge(
+    'oauth_circuit_open', 'Whether calls to the identity provider are being rejected.',
+    function=lambda: int(oauth_transport.breaker.state == 'open'),
+))
 
 oauth = OAuth()
 oauth.register(
     name='google',
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+    client_cls=CachedOAuth2App,
+    server_metadata_url=OIDC_METADATA_URL,
     client_id=CLIENT_ID,
     client_secret=CLIENT_SECRET,
+    metadata_ttl=OIDC_METADATA_TTL,
+    jwks_ttl=OIDC_JWKS_TTL,
     client_kwargs={
         'scope': 'email openid profile',
-        'redirect_url': 'http://localhost:8000/auth'
+        'redirect_url': 'http://localhost:8000/auth',
+        'transport': oauth_transport,
+        'timeout': httpx.Timeout(OAUTH_READ_TIMEOUT, connect=OAUTH_CONNECT_TIMEOUT),
     }
 )
 
 
 templates = Jinja2Templates(directory="templates")
+static_assets.install(templates)
+pages = PageCache(templates, bytecode_cache_dir=TEMPLATE_CACHE_DIR, enabled=PAGE_CACHE)
+
+audit = None
+if AUDIT_SINK != 'off':
+    audit = audit_log.AuditLog(
+        audit_log.open_sink(AUDIT_SINK, AUDIT_PATH),
+        max_queue=AUDIT_QUEUE_SIZE,
+        batch_size=AUDIT_BATCH_SIZE,
+        flush_interval=AUDIT_FLUSH_INTERVAL,
+        overflow=AUDIT_OVERFLOW,
+    )
+    metrics.registry.register(metrics.Gauge(
+        'audit_queue_depth', 'Audit events waiting to be written.', function=lambda: len(audit)))
+
+avatars = AvatarCache(
+    AVATAR_CACHE_DIR,
+    fallback_path='static/icons/avatar.png',
+    size=AVATAR_SIZE,
+    max_bytes=AVATAR_CACHE_BYTES,
+)
 
 
 @app.get("/")
@@ -108,7 +201,7 @@ def index(request: Request):
     if user:
         return RedirectResponse('welcome')
 
-    return templates.TemplateResponse(
+    return pages.TemplateResponse(
         name="home.html",
         context={"request": request}
     )
@@ -119,16 +212,43 @@ def welcome(request: Request):
     user = request.session.get('user')
     if not user:
         return RedirectResponse('/')
-    return templates.TemplateResponse(
+    return pages.TemplateResponse(
         name='welcome.html',
-        context={'request': request, 'user': user}
+        context={'request': request, 'user': user},
+        key=(user.get('family_name'), user.get('sub')),
+        private=True
+    )
+
+
+@app.get('/avatar/{user}')
+async def avatar(request: Request, user: str):
+    profile = request.session.get('user')
+    if not profile or profile.get('sub') != user or not profile.get('picture'):
+        return avatars.fallback_response(request)
+    return await avatars.response(request, profile['picture'])
+
+
+@app.get('/metrics')
+def metrics_view():
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type='text/plain; version=0.0.4; charset=utf-8'
     )
 
 
 @app.get("/login")
 async def login(request: Request):
     url = request.url_for('auth')
-    return await oauth.google.authorize_redirect(request, url)
+    try:
+        return await oauth.google.authorize_redirect(request, url)
+    except OAuthError as e:
+        if audit is not None:
+            audit.record('error', stage='login', error=e.error, **audit_log.client_details(request))
+        return pages.TemplateResponse(
+            name='error.html',
+            context={'request': request, 'error': e.error},
+            key=(e.error,)
+        )
 
 
 @app.get('/auth')
@@ -136,17 +256,26 @@ async def auth(request: Request):
     try:
         token = await oauth.google.authorize_access_token(request)
     except OAuthError as e:
-        return templates.TemplateResponse(
+        if audit is not None:
+            audit.record('error', stage='auth', error=e.error, **audit_log.client_details(request))
+        return pages.TemplateResponse(
             name='error.html',
-            context={'request': request, 'error': e.error}
+            context={'request': request, 'error': e.error},
+            key=(e.error,)
         )
     user = token.get('userinfo')
     if user:
         request.session['user'] = dict(user)
+        if audit is not None:
+            audit.record('login', email=user.get('email'), sub=user.get('sub'),
+                         **audit_log.client_details(request))
     return RedirectResponse('welcome')
 
 
 @app.get('/logout')
 def logout(request: Request):
-    request.session.pop('user')
+    user = request.session.pop('user')
+    if audit is not None:
+        audit.record('logout', email=user.get('email'), sub=user.get('sub'),
+                     **audit_log.client_details(request))
     return RedirectResponse('/')
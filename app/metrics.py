@@ -0,0 +1,257 @@
+import collections
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, seconds, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        names = self.label_names + ('le',)
+        # /metrics renders in the threadpool while the loop adds series.
+        for labels, (counts, total) in sorted(list(self._series.items())):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, _labels(names, labels + (le,)), cumulative))
+            suffix = _labels(self.label_names, labels)
+            lines.append('{}_sum{} {!r}'.format(self.name, suffix, total))
+            lines.append('{}_count{} {}'.format(self.name, suffix, cumulative))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values = collections.Counter()
+
+    def inc(self, *labels):
+        self._values[labels] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        for labels, value in sorted(list(self._values.items())):
+            lines.append('{}{} {}'.format(self.name, _labels(self.label_names, labels), value))
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def render(self):
+        value = self.function() if self.function is not None else self.value
+        return ['# HELP {} {}'.format(self.name, self.help),
+                '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, value)]
+
+
+class Registry:
+    """Metrics for this worker process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request.', ('route', 'method')))
+responses = registry.register(Counter(
+    'http_responses_total', 'Responses sent, by status code.', ('route', 'method', 'status')))
+in_flight = registry.register(Gauge(
+    'http_requests_in_flight', 'Requests currently being handled.'))
+stage_seconds = registry.register(Histogram(
+    'app_stage_duration_seconds', 'Time spent in hot-path stages of a request.', ('stage',)))
+outbound_seconds = registry.register(Histogram(
+    'oauth_outbound_duration_seconds', 'Identity provider calls, by endpoint and outcome.',
+    ('endpoint', 'outcome')))
+
+
+def observe_outbound(request, seconds, outcome):
+    outbound_seconds.observe(seconds, request.url.path, outcome)
+
+
+class stage:
+    """``with stage('template_render'):`` times a block into ``stage_seconds``."""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stage_seconds.observe(time.perf_counter() - self.start, self.name)
+
+
+def method_label(scope):
+    # Clients pick the method, so anything unusual shares one series.
+    method = scope['method']
+    return method if method in METHODS else 'other'
+
+
+def route_label(scope, root_path):
+    route = scope.get('route')
+    if route is not None:
+        return route.path
+    # Mounted apps such as /static only leave their prefix behind.
+    mounted = scope.get('root_path', '')
+    if mounted != root_path:
+        return mounted + '/{path}'
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """Records latency, status and in-flight requests for every HTTP request.
+
+    When ``profiler`` is given, requests slower than its threshold get the
+    stack samples taken while they ran written out for a flamegraph.
+    """
+
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        root_path = scope.get('root_path', '')
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        in_flight.value += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_flight.value -= 1
+            route = route_label(scope, root_path)
+            method = method_label(scope)
+            request_seconds.observe(elapsed, route, method)
+            responses.inc(route, method, status[0])
+            if self.profiler is not None and elapsed >= self.profiler.threshold:
+                self.profiler.dump(start, elapsed, '{} {}'.format(method, route))
+
+
+class SlowRequestProfiler:
+    """Opt-in sampling profiler for slow requests.
+
+    A daemon thread samples the stacks of every thread each ``interval``
+    seconds into a short ring buffer. When a request takes longer than
+    ``threshold``, the samples taken while it ran are written to
+    ``directory`` in the collapsed-stack format that flamegraph.pl and
+    speedscope read. Requests share the event loop, so the samples show
+    everything the worker was doing during the slow request, which is
+    what matters when something blocks the loop.
+    """
+
+    def __init__(self, directory, threshold=0.5, interval=0.005, window=30.0):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self._samples = collections.deque(maxlen=int(window / interval))
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stopped.wait(self.interval):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                name = names.get(ident, str(ident))
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(name)
+                self._samples.append((now, ';'.join(reversed(stack))))
+
+    def dump(self, start, elapsed, label):
+        end = start + elapsed
+        stacks = collections.Counter(stack for at, stack in list(self._samples) if start <= at <= end)
+        if not stacks:
+            return None
+        filename = '{}-{}-{}ms.folded'.format(
+            time.strftime('%Y%m%dT%H%M%S'),
+            ''.join(c if c.isalnum() else '_' for c in label).strip('_'),
+            int(elapsed * 1000),
+        )
+        path = os.path.join(self.directory, filename)
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return path
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import re
+import time
+
+from authlib.integrations.starlette_client import OAuthError, StarletteOAuth2App
+from joserfc.errors import InvalidKeyIdError
+
+log = logging.getLogger(__name__)
+
+MAX_AGE_RE = re.compile(r'(?:^|,)\s*(?:s-)?max-age\s*=\s*"?(\d+)"?', re.I)
+
+
+def cache_ttl(headers, default_ttl, min_ttl, max_ttl):
+    """Work out how long a response may be cached from its headers."""
+    cache_control = headers.get('cache-control', '')
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return min_ttl
+    match = MAX_AGE_RE.search(cache_control)
+    if not match:
+        return default_ttl
+    ttl = int(match.group(1))
+    try:
+        ttl -= int(headers.get('age', 0))
+    except ValueError:
+        pass
+    return max(min_ttl, min(ttl, max_ttl))
+
+
+class DocumentCache:
+    """A JSON document fetched from the provider and shared by every request
+    in the worker.
+
+    Concurrent misses share a single upstream fetch, the document is refreshed
+    in the background before it expires, and a failed refresh keeps serving
+    the last good copy.
+    """
+
+    def __init__(self, loader, default_ttl=3600, min_ttl=60, max_ttl=86400,
+                 refresh_ahead=0.8, min_force_interval=60):
+        self._loader = loader
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_force_interval = min_force_interval
+        self.value = None
+        self.fetched_at = 0.0
+        self.refresh_at = 0.0
+        self.expires_at = 0.0
+        self.forced_at = float('-inf')
+        self.fetches = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def fresh(self):
+        return self.value is not None and time.monotonic() < self.expires_at
+
+    async def get(self, force=False):
+        if not force and self.fresh():
+            return self.value
+        return await self.refresh(force=force)
+
+    async def refresh(self, force=False):
+        fetched_at = self.fetched_at
+        async with self._lock:
+            # Another coroutine already refreshed while we were waiting.
+            if self.fetched_at != fetched_at and self.value is not None:
+                return self.value
+            if not force and self.fresh() and time.monotonic() < self.refresh_at:
+                return self.value
+            # Unknown ``kid`` values must not let callers hammer the provider,
+            # but a routine refresh must not block picking up a rotated key.
+            if force and self.value is not None:
+                if time.monotonic() - self.forced_at < self.min_force_interval:
+                    return self.value
+                self.forced_at = time.monotonic()
+            try:
+                value, headers = await self._loader()
+            except Exception:
+                if self.value is None:
+                    raise
+                log.warning('Refresh failed, serving stale document', exc_info=True)
+                self.expires_at = time.monotonic() + self.min_ttl
+                self.refresh_at = self.expires_at
+                return self.value
+            self.fetches += 1
+            self._store(value, headers)
+            return value
+
+    def _store(self, value, headers):
+        ttl = cache_ttl(headers, self.default_ttl, self.min_ttl, self.max_ttl)
+        now = time.monotonic()
+        self.value = value
+        self.fetched_at = now
+        self.expires_at = now + ttl
+        self.refresh_at = now + ttl * self.refresh_ahead
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            delay = max(self.refresh_at - time.monotonic(), 1.0)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception:
+                log.warning('Background refresh failed', exc_info=True)
+                await asyncio.sleep(self.min_ttl)
+
+
+class CachedOAuth2App(StarletteOAuth2App):
+    """Starlette OAuth app whose discovery document and JWKS are cached per
+    worker with TTLs instead of being loaded once and kept forever."""
+
+    def __init__(self, framework, name=None, metadata_ttl=3600, jwks_ttl=3600,
+                 **kwargs):
+        super().__init__(framework, name, **kwargs)
+        self.metadata_cache = DocumentCache(self._fetch_metadata, default_ttl=metadata_ttl)
+        self.jwks_cache = DocumentCache(self._fetch_jwks, default_ttl=jwks_ttl)
+        self._merged = (None, None)
+
+    async def _fetch_json(self, url):
+        async with self._get_session() as client:
+            resp = await client.request('GET', url, withhold_token=True)
+            resp.raise_for_status()
+            return resp.json(), resp.headers
+
+    async def _fetch_metadata(self):
+        return await self._fetch_json(self._server_metadata_url)
+
+    async def _fetch_jwks(self):
+        metadata = await self.load_server_metadata()
+        uri = metadata.get('jwks_uri')
+        if not uri:
+            raise RuntimeError('Missing "jwks_uri" in metadata')
+        return await self._fetch_json(uri)
+
+    async def load_server_metadata(self):
+        if not self._server_metadata_url:
+            return self.server_metadata
+        document = await self.metadata_cache.get()
+        source, merged = self._merged
+        if source is not document:
+            merged = dict(self.server_metadata)
+            merged.update(document)
+            self._merged = (document, merged)
+        return merged
+
+    async def fetch_jwk_set(self, force=False):
+        jwk_set = self.server_metadata.get('jwks')
+        if jwk_set and not force:
+            return jwk_set
+        return await self.jwks_cache.get(force=force)
+
+    async def parse_id_token(self, token, nonce, *args, **kwargs):
+        try:
+            return await super().parse_id_token(token, nonce, *args, **kwargs)
+        except InvalidKeyIdError as e:
+            # Still unknown after refetching the keys (or inside the rate limit).
+            raise OAuthError(error='invalid_token', description=str(e)) from e
+
+    async def warm_up(self):
+        """Load metadata and keys ahead of the first login and keep them
+        refreshed in the background."""
+        try:
+            await self.load_server_metadata()
+            await self.fetch_jwk_set()
+        except Exception:
+            log.warning('Could not warm up OIDC metadata for %s', self.name, exc_info=True)
+        if self._server_metadata_url:
+            self.metadata_cache.start()
+            self.jwks_cache.start()
+
+    async def close(self):
+        await self.metadata_cache.stop()
+        await self.jwks_cache.stop()
@@ -0,0 +1,176 @@
+import asyncio
+import functools
+import logging
+import ssl
+import time
+
+import certifi
+import httpx
+from authlib.integrations.starlette_client import OAuthError
+
+log = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def ssl_context():
+    """One CA bundle load for every outbound client; each costs ~50ms."""
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+class ProviderUnavailable(OAuthError):
+    """The identity provider is slow, failing or behind an open breaker."""
+
+    def __init__(self, description=None):
+        super().__init__(error='temporarily_unavailable', description=description)
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and rejects
+    calls for ``reset_timeout`` seconds; then lets a single trial call
+    through and closes again if it succeeds."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def release(self):
+        """Give up a trial call that ended without a verdict, e.g. when it
+        was cancelled, so the next call can try again."""
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                log.warning('Circuit opened after %d failures', self.failures)
+            self.opened_at = time.monotonic()
+
+
+class GuardedTransport(httpx.AsyncBaseTransport):
+    """One keep-alive connection pool per worker, shared by every client
+    authlib creates.
+
+    At most ``max_concurrency`` requests are in flight; others queue for up
+    to ``queue_timeout`` seconds. Timeouts, connection errors, a full queue
+    and 5xx responses count against the circuit breaker, and all of them
+    surface as :class:`ProviderUnavailable` so views can render
+    ``error.html``.
+    """
+
+    def __init__(self, pool_size=20, max_concurrency=20, queue_timeout=2.0,
+                 keepalive_expiry=60.0, breaker=None, observer=None):
+        self._transport = httpx.AsyncHTTPTransport(
+            verify=ssl_context(),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.queue_timeout = queue_timeout
+        self.breaker = breaker or CircuitBreaker()
+        # observer(request, seconds, outcome) is told about every call.
+        self.observer = observer
+
+    def _observe(self, request, start, outcome):
+        if self.observer is not None:
+            self.observer(request, time.perf_counter() - start, outcome)
+
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        if not self.breaker.allow():
+            self._observe(request, start, 'circuit_open')
+            raise ProviderUnavailable('Identity provider circuit is open')
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # A backed-up queue means the provider is too slow to keep up.
+            self.breaker.record_failure()
+            self._observe(request, start, 'queue_full')
+            raise ProviderUnavailable('Too many pending requests to the identity provider')
+        except BaseException:
+            self.breaker.release()
+            raise
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.TransportError as e:
+            self._slots.release()
+            self.breaker.record_failure()
+            self._observe(request, start, type(e).__name__)
+            raise ProviderUnavailable(repr(e)) from e
+        except BaseException:
+            self._slots.release()
+            self.breaker.release()
+            raise
+        self._observe(request, start, str(response.status_code))
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            await response.aclose()
+            self._slots.release()
+            raise ProviderUnavailable('Identity provider returned {}'.format(response.status_code))
+        self.breaker.record_success()
+        # The slot is held until the body has been read and closed.
+        response.stream = _ReleasingStream(
+            response.stream, self._slots.release, self.breaker.record_failure)
+        return response
+
+    async def __aexit__(self, *args):
+        # authlib closes every client it creates; the pool must outlive them.
+        pass
+
+    async def aclose(self):
+        pass
+
+    async def close(self):
+        await self._transport.aclose()
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release, on_failure):
+        self._stream = stream
+        self._release = release
+        self._on_failure = on_failure
+
+    async def __aiter__(self):
+        # A provider that sends headers and then stalls fails like any other.
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except httpx.TransportError as e:
+            self._on_failure()
+            raise ProviderUnavailable(repr(e)) from e
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache
+from starlette.responses import Response
+
+from .metrics import stage
+
+
+class PageCache:
+    """Rendered template bytes, cached per worker.
+
+    A page is cached under its template, the request's base URL (which
+    ``url_for`` bakes into the output) and ``key``: the context values the
+    template actually uses. Entries are dropped as soon as Jinja reloads the
+    template because the file changed on disk. Sync routes call this from
+    the threadpool, so the LRU bookkeeping happens under a lock.
+    """
+
+    def __init__(self, templates, bytecode_cache_dir=None, max_entries=10_000, enabled=True):
+        self.templates = templates
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            templates.env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+    def TemplateResponse(self, name, context, key=(), private=False):
+        request = context['request']
+        if not self.enabled:
+            with stage('template_render'):
+                return self.templates.TemplateResponse(name=name, context=context)
+
+        # get_template() checks the file's mtime and hands back a new
+        # Template object after an edit, which invalidates the entries below.
+        template = self.templates.get_template(name)
+        cache_key = (name, str(request.base_url), key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] is template:
+                self._entries.move_to_end(cache_key)
+        if entry is None or entry[0] is not template:
+            with stage('template_render'):
+                body = template.render(context).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+            entry = (template, body, etag)
+            with self._lock:
+                self._entries[cache_key] = entry
+                self._entries.move_to_end(cache_key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        _, body, etag = entry
+        headers = {
+            'etag': etag,
+            'cache-control': 'private, no-cache' if private else 'no-cache',
+            'vary': 'Cookie',
+        }
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type='text/html', headers=headers)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,155 @@
+"""Pre-forking production server.
+
+The parent imports ``app.main`` once, binds the listening socket and forks
+``server-workers`` children that each run uvicorn on the shared socket, so
+the app's import cost is paid once and its read-only pages are shared
+copy-on-write. The parent only supervises: it restarts workers that die,
+and on SIGTERM/SIGINT it asks every worker to drain its in-flight requests
+and kills the ones still running after ``server-graceful-timeout``.
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from . import config
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def bind(host, port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def uvicorn_config(app):
+    return uvicorn.Config(
+        app,
+        loop=config.SERVER_LOOP,
+        http=config.SERVER_HTTP,
+        lifespan='on',
+        proxy_headers=True,
+        forwarded_allow_ips=config.FORWARDED_ALLOW_IPS,
+        timeout_graceful_shutdown=config.SERVER_GRACEFUL_TIMEOUT,
+    )
+
+
+def serve(app, sock):
+    """Worker body: run uvicorn on the inherited socket until told to stop."""
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    server = uvicorn.Server(uvicorn_config(app))
+    server.run(sockets=[sock])
+    return 0 if server.started else 3
+
+
+class Supervisor:
+    def __init__(self, app, sock, workers):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = serve(self.app, self.sock)
+            except BaseException:
+                logger.exception('Worker crashed')
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        logger.info('Started worker [%d]', pid)
+
+    def stop(self, signum, frame):
+        if not self.stopping:
+            logger.info('Draining %d workers', len(self.children))
+            self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            logger.warning('Worker [%d] exited with %d', pid, code)
+            if code == 3 or time.monotonic() - started < 1:
+                # Dying during startup would only loop; back off first.
+                time.sleep(1)
+            self.spawn()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        while not self.stopping:
+            self.reap()
+            time.sleep(0.2)
+
+        deadline = time.monotonic() + config.SERVER_GRACEFUL_TIMEOUT + 5
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.children:
+            logger.warning('Killing worker [%d] that did not drain in time', pid)
+            os.kill(pid, signal.SIGKILL)
+        while self.children:
+            self.reap()
+            time.sleep(0.05)
+        self.sock.close()
+        return 0
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s:     %(message)s')
+    errors = config.problems()
+    for error in errors:
+        logger.error('Configuration: %s', error)
+    if errors and config.PRODUCTION:
+        return 1
+
+    start = time.perf_counter()
+    from .main import app
+    logger.info('Loaded app in %.0f ms', (time.perf_counter() - start) * 1000)
+
+    if not hasattr(os, 'fork'):
+        uvicorn.run('app.main:app', host=config.SERVER_HOST, port=config.SERVER_PORT,
+                    workers=config.SERVER_WORKERS, loop=config.SERVER_LOOP,
+                    http=config.SERVER_HTTP, proxy_headers=True,
+                    forwarded_allow_ips=config.FORWARDED_ALLOW_IPS,
+                    timeout_graceful_shutdown=config.SERVER_GRACEFUL_TIMEOUT)
+        return 0
+
+    sock = bind(config.SERVER_HOST, config.SERVER_PORT)
+    logger.info('Listening on http://%s:%d with %d workers',
+                config.SERVER_HOST, config.SERVER_PORT, config.SERVER_WORKERS)
+    return Supervisor(app, sock, config.SERVER_WORKERS).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
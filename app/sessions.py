@@ -0,0 +1,313 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+
+from .metrics import stage
+
+
+class Session(dict):
+    """``request.session`` for server-side sessions; remembers whether it
+    was changed so untouched sessions are never written back."""
+
+    modified = False
+
+    def __setitem__(self, key, value):
+        self.modified = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.modified = True
+        super().__delitem__(key)
+
+    def clear(self):
+        self.modified = True
+        super().clear()
+
+    def pop(self, key, *args):
+        if key in self:
+            self.modified = True
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self.modified = True
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.modified = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.modified = True
+        super().update(*args, **kwargs)
+
+
+class MemoryStore:
+    """Per-process LRU session store with sliding expiry.
+
+    Entries are kept in expiry order, so sweeping only pops from the front.
+    """
+
+    now = staticmethod(time.monotonic)
+
+    def __init__(self, max_age=14 * 24 * 60 * 60, max_entries=100_000,
+                 touch_interval=60, sweep_interval=60):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.sweep_interval = sweep_interval
+        self._entries = OrderedDict()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def load(self, sid):
+        entry = self._entries.get(sid)
+        if entry is None:
+            return None
+        data, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[sid]
+            return None
+        return dict(data), expires_at
+
+    def save(self, sid, data):
+        self._entries[sid] = (dict(data), time.monotonic() + self.max_age)
+        self._entries.move_to_end(sid)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._maybe_sweep()
+
+    def touch(self, sid):
+        entry = self._entries.get(sid)
+        if entry is None:
+            return False
+        now = time.monotonic()
+        data, expires_at = entry
+        if expires_at - now > self.max_age - self.touch_interval:
+            return False
+        self._entries[sid] = (data, now + self.max_age)
+        self._entries.move_to_end(sid)
+        self._maybe_sweep()
+        return True
+
+    def delete(self, sid):
+        self._entries.pop(sid, None)
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep()
+
+    def sweep(self):
+        now = time.monotonic()
+        removed = 0
+        while self._entries:
+            sid, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[sid]
+            removed += 1
+        return removed
+
+    def close(self):
+        self._entries.clear()
+
+
+class SQLiteStore:
+    """Session store backed by a SQLite file, shared between workers.
+
+    The calls are made inline on the event loop. Saves and deletes only
+    happen on login/logout. The middleware only calls ``touch()`` once a
+    session's expiry is more than ``touch_interval`` seconds old, so reads
+    never take SQLite's write lock. Touches and sweeps are best effort:
+    they wait at most ``best_effort_timeout`` for the lock held by another
+    worker and try again later. Each process opens its own connection on
+    first use, so the store can be created before the server forks its
+    workers.
+    """
+
+    now = staticmethod(time.time)
+
+    def __init__(self, path='sessions.db', max_age=14 * 24 * 60 * 60,
+                 touch_interval=60, sweep_interval=300, busy_timeout=5.0,
+                 best_effort_timeout=0.05):
+        self.path = path
+        self.max_age = max_age
+        self.touch_interval = touch_interval
+        self.sweep_interval = sweep_interval
+        self.busy_timeout = busy_timeout
+        self.best_effort_timeout = best_effort_timeout
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        db = self._connect()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            ' id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)'
+        )
+        db.close()
+        self._next_sweep = time.time() + sweep_interval
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                             check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    @property
+    def _db(self):
+        if self._pid != os.getpid():
+            self._conn = self._connect()
+            self._pid = os.getpid()
+        return self._conn
+
+    def load(self, sid):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data, expires_at FROM sessions WHERE id = ?', (sid,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def save(self, sid, data):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+                (sid, json.dumps(data), time.time() + self.max_age),
+            )
+        self._maybe_sweep()
+
+    def touch(self, sid):
+        now = time.time()
+        return self._try_write(
+            'UPDATE sessions SET expires_at = ? WHERE id = ? AND expires_at < ?',
+            (now + self.max_age, sid, now + self.max_age - self.touch_interval),
+        ) > 0
+
+    def _try_write(self, sql, params):
+        """Run a write that can wait for another time; 0 rows if the lock is busy."""
+        with self._lock:
+            db = self._db
+            db.execute('PRAGMA busy_timeout = {:d}'.format(int(self.best_effort_timeout * 1000)))
+            try:
+                return db.execute(sql, params).rowcount
+            except sqlite3.OperationalError:
+                return 0
+            finally:
+                db.execute('PRAGMA busy_timeout = {:d}'.format(int(self.busy_timeout * 1000)))
+
+    def delete(self, sid):
+        with self._lock:
+            self._db.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.sweep()
+
+    def sweep(self):
+        return self._try_write('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+            self._pid = None
+
+
+class ServerSessionMiddleware:
+    """Drop-in replacement for Starlette's ``SessionMiddleware`` that keeps
+    the session data in ``store`` and only puts a signed opaque id in the
+    cookie."""
+
+    def __init__(self, app, store, secret_key, session_cookie='session',
+                 path='/', same_site='lax', https_only=False):
+        self.app = app
+        self.store = store
+        self.key = secret_key.encode('utf-8')
+        self.session_cookie = session_cookie
+        self.max_age = store.max_age
+        self.path = path
+        self.security_flags = 'httponly; samesite=' + same_site
+        if https_only:
+            self.security_flags += '; secure'
+
+    def touch_due(self, expires_at):
+        # Most requests fall inside the interval and never write.
+        return expires_at - self.store.now() < self.store.max_age - self.store.touch_interval
+
+    def sign(self, sid):
+        digest = hmac.new(self.key, sid.encode('utf-8'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest[:16]).rstrip(b'=').decode('ascii')
+
+    def unsign(self, value):
+        sid, _, signature = value.rpartition('.')
+        expected = self.sign(sid).encode('ascii')
+        if sid and hmac.compare_digest(signature.encode('utf-8'), expected):
+            return sid
+        return None
+
+    def cookie(self, sid):
+        return '{}={}.{}; path={}; Max-Age={}; {}'.format(
+            self.session_cookie, sid, self.sign(sid), self.path,
+            self.max_age, self.security_flags,
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+
+        sid = None
+        data = None
+        expires_at = None
+        value = HTTPConnection(scope).cookies.get(self.session_cookie)
+        if value:
+            sid = self.unsign(value)
+            if sid is not None:
+                with stage('session_load'):
+                    loaded = self.store.load(sid)
+                if loaded is not None:
+                    data, expires_at = loaded
+        scope['session'] = Session(data or {})
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                session = scope['session']
+                headers = MutableHeaders(scope=message)
+                if session.modified and session:
+                    # A fresh id on every write keeps login from reusing a
+                    # pre-authentication id.
+                    new_sid = secrets.token_urlsafe(16)
+                    with stage('session_save'):
+                        if data is not None:
+                            self.store.delete(sid)
+                        self.store.save(new_sid, dict(session))
+                    headers.append('Set-Cookie', self.cookie(new_sid))
+                elif session.modified and data is not None:
+                    self.store.delete(sid)
+                    headers.append('Set-Cookie', '{}=null; path={}; expires=Thu, 01 Jan 1970 00:00:00 GMT; {}'.format(
+                        self.session_cookie, self.path, self.security_flags,
+                    ))
+                elif data is not None and self.touch_due(expires_at) and self.store.touch(sid):
+                    headers.append('Set-Cookie', self.cookie(sid))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,149 @@
+"""A stand-in for Google's OpenID Connect endpoints, for benchmarks.
+
+Implements discovery, JWKS, an authorize endpoint that approves every
+request straight away, a token endpoint that issues RS256-signed id_tokens
+and a profile picture. ``/_control`` injects latency, errors or a body
+that stalls after the headers into the token endpoint and reports how
+often each endpoint was hit::
+
+    uvicorn bench.fake_oidc:app --port 8766
+    curl '127.0.0.1:8766/_control?latency=0.2&error_rate=0.1&stall=0'
+"""
+import asyncio
+import os
+import random
+import secrets
+import time
+from urllib.parse import parse_qsl, urlencode
+
+from joserfc import jwt
+from joserfc.jwk import RSAKey
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+KEY = RSAKey.generate_key(2048, parameters={'kid': 'bench', 'use': 'sig', 'alg': 'RS256'})
+PICTURE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'static', 'icons', 'avatar.png')
+
+codes = {}
+control = {'latency': 0.0, 'error_rate': 0.0, 'stall': 0.0}
+hits = {}
+
+
+def issuer(request):
+    return str(request.base_url).rstrip('/')
+
+
+def count(name):
+    hits[name] = hits.get(name, 0) + 1
+
+
+async def discovery(request):
+    count('discovery')
+    base = issuer(request)
+    return JSONResponse({
+        'issuer': base,
+        'authorization_endpoint': base + '/authorize',
+        'token_endpoint': base + '/token',
+        'userinfo_endpoint': base + '/userinfo',
+        'jwks_uri': base + '/jwks',
+        'response_types_supported': ['code'],
+        'subject_types_supported': ['public'],
+        'id_token_signing_alg_values_supported': ['RS256'],
+    }, headers={'cache-control': 'public, max-age=3600'})
+
+
+async def jwks(request):
+    count('jwks')
+    return JSONResponse({'keys': [KEY.as_dict(private=False)]},
+                        headers={'cache-control': 'public, max-age=3600'})
+
+
+async def authorize(request):
+    count('authorize')
+    params = request.query_params
+    code = secrets.token_urlsafe(16)
+    codes[code] = (params['client_id'], params.get('nonce'))
+    query = urlencode({'code': code, 'state': params['state']})
+    return RedirectResponse('{}?{}'.format(params['redirect_uri'], query), status_code=302)
+
+
+def token_response(payload, status_code=200):
+    if not control['stall']:
+        return JSONResponse(payload, status_code=status_code)
+    body = JSONResponse(payload).body
+
+    async def stalled():
+        # The headers are already out; hold the body back.
+        await asyncio.sleep(control['stall'])
+        yield body
+
+    return StreamingResponse(stalled(), status_code=status_code, media_type='application/json')
+
+
+async def token(request):
+    count('token')
+    if control['latency']:
+        await asyncio.sleep(control['latency'])
+    if random.random() < control['error_rate']:
+        return JSONResponse({'error': 'server_error'}, status_code=503)
+
+    form = dict(parse_qsl((await request.body()).decode('utf-8')))
+    try:
+        client_id, nonce = codes.pop(form['code'])
+    except KeyError:
+        return token_response({'error': 'invalid_grant'}, status_code=400)
+    user = secrets.randbelow(10_000)
+    now = int(time.time())
+    claims = {
+        'iss': issuer(request),
+        'aud': client_id,
+        'azp': client_id,
+        'sub': str(100000 + user),
+        'email': 'user{}@example.com'.format(user),
+        'email_verified': True,
+        'name': 'Bench User{}'.format(user),
+        'given_name': 'Bench',
+        'family_name': 'User{}'.format(user),
+        'picture': issuer(request) + '/picture.png',
+        'locale': 'en',
+        'iat': now,
+        'exp': now + 3600,
+    }
+    if nonce:
+        claims['nonce'] = nonce
+    id_token = jwt.encode({'alg': 'RS256', 'kid': 'bench'}, claims, KEY)
+    return token_response({
+        'access_token': secrets.token_urlsafe(32),
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+        'scope': 'openid email profile',
+        'id_token': id_token,
+    })
+
+
+with open(PICTURE_PATH, 'rb') as f:
+    PICTURE = f.read()
+
+
+async def picture(request):
+    count('picture')
+    return Response(PICTURE, media_type='image/png')
+
+
+async def control_view(request):
+    for name in control:
+        if name in request.query_params:
+            control[name] = float(request.query_params[name])
+    return JSONResponse({'control': control, 'hits': hits})
+
+
+app = Starlette(routes=[
+    Route('/.well-known/openid-configuration', discovery),
+    Route('/jwks', jwks),
+    Route('/authorize', authorize),
+    Route('/token', token, methods=['POST']),
+    Route('/picture.png', picture),
+    Route('/_control', control_view),
+])
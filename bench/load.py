@@ -0,0 +1,294 @@
+"""Load test ``app.main:app`` end to end, without network access.
+
+Starts the bundled fake Google provider (``bench/fake_oidc.py``) and the app
+under uvicorn, drives each scenario at the given concurrency and prints
+req/s, p50/p95/p99 latency and the RSS of every app process::
+
+    python -m bench.load --concurrency 20 --duration 10
+    python -m bench.load --save default        # write bench/baselines/default.json
+    python -m bench.load --compare default     # exit 1 on a regression
+    env audit-sink=off python -m bench.load --scenario login
+
+Scenarios:
+    anonymous  GET / without a session
+    static     GET the fingerprinted assets linked from home.html
+    login      /login -> provider -> /auth -> /welcome (+ avatar) -> /logout
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, 'bench', 'baselines')
+SCENARIOS = ('anonymous', 'static', 'login')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(target, port, env=None, workers=1):
+    command = [sys.executable, '-m', 'uvicorn', target, '--host', '127.0.0.1',
+               '--port', str(port), '--log-level', 'warning', '--no-access-log']
+    if workers > 1:
+        command += ['--workers', str(workers)]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} exited with {}'.format(url, process.returncode))
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError('{} did not come up'.format(url))
+
+
+def rss_by_process(pid):
+    """RSS in MiB of ``pid`` and its children (the uvicorn workers)."""
+    pids = [pid]
+    try:
+        with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    rss = {}
+    for p in pids:
+        try:
+            with open('/proc/{}/status'.format(p)) as f:
+                match = re.search(r'^VmRSS:\s+(\d+) kB', f.read(), re.M)
+        except OSError:
+            continue
+        if match:
+            rss[str(p)] = round(int(match.group(1)) / 1024, 1)
+    return rss
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = 0
+
+    async def request(self, client, method, url, route, expect=(200, 302, 303, 307)):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url)
+        except httpx.HTTPError:
+            self.errors += 1
+            return None
+        elapsed = time.perf_counter() - start
+        if response.status_code not in expect:
+            self.errors += 1
+            return None
+        self.latencies.setdefault(route, []).append(elapsed)
+        return response
+
+    def summary(self, elapsed):
+        everything = sorted(v for values in self.latencies.values() for v in values)
+        result = self._stats(everything, elapsed)
+        result['errors'] = self.errors
+        result['routes'] = {
+            route: self._stats(sorted(values), elapsed)
+            for route, values in sorted(self.latencies.items())
+        }
+        return result
+
+    @staticmethod
+    def _stats(values, elapsed):
+        ms = lambda v: round(v * 1000, 3) if v is not None else None  # noqa: E731
+        return {
+            'requests': len(values),
+            'rps': round(len(values) / elapsed, 1),
+            'p50_ms': ms(percentile(values, 50)),
+            'p95_ms': ms(percentile(values, 95)),
+            'p99_ms': ms(percentile(values, 99)),
+        }
+
+
+async def anonymous(client, recorder, base, assets):
+    await recorder.request(client, 'GET', base + '/', '/')
+
+
+async def static(client, recorder, base, assets):
+    for url in assets:
+        await recorder.request(client, 'GET', url, '/static')
+
+
+async def login(client, recorder, base, assets):
+    response = await recorder.request(client, 'GET', base + '/login', '/login')
+    if response is None:
+        return
+    # The provider round trip is not ours to measure.
+    try:
+        response = await client.get(response.headers['location'])
+    except httpx.HTTPError:
+        recorder.errors += 1
+        return
+    response = await recorder.request(client, 'GET', response.headers['location'], '/auth')
+    if response is None:
+        return
+    response = await recorder.request(client, 'GET', base + '/welcome', '/welcome')
+    if response is None:
+        return
+    match = re.search(r'src="([^"]*/avatar/[^"]+)"', response.text)
+    if match:
+        await recorder.request(client, 'GET', match.group(1), '/avatar/{user}')
+    await recorder.request(client, 'GET', base + '/logout', '/logout')
+
+
+async def run_scenario(scenario, base, assets, concurrency, duration):
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+
+    async def user():
+        limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            while time.monotonic() < deadline:
+                client.cookies.clear()
+                await scenario(client, recorder, base, assets)
+
+    start = time.monotonic()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return recorder.summary(time.monotonic() - start)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        if result['rps'] < old['rps'] * (1 - tolerance):
+            regressions.append('{}: {} req/s, baseline {}'.format(name, result['rps'], old['rps']))
+        # p99 over a few seconds is too noisy to gate on.
+        if old['p95_ms'] and result['p95_ms'] and result['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {} ms, baseline {} ms'.format(
+                name, result['p95_ms'], old['p95_ms']))
+    return regressions
+
+
+def report(results):
+    print('{:<10} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for name, result in results['scenarios'].items():
+        print('{:<10} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+            name, result['rps'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['errors']))
+        for route, stats in result['routes'].items():
+            if len(result['routes']) > 1:
+                print('  {:<16} {:>7} {:>9} {:>9} {:>9}'.format(
+                    route, stats['rps'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+    print('RSS MiB by process: {}'.format(results['rss_mib']))
+
+
+async def drive(args, base):
+    async with httpx.AsyncClient() as client:
+        home = (await client.get(base + '/')).text
+    assets = re.findall(r'(?:href|src)="([^"]*/static/[^"]+)"', home)
+    scenarios = {}
+    for name in args.scenario:
+        scenarios[name] = await run_scenario(
+            globals()[name], base, assets, args.concurrency, args.duration)
+    return scenarios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--save', metavar='NAME', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='NAME', help='compare against a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    args = parser.parse_args(argv)
+    args.scenario = args.scenario or list(SCENARIOS)
+
+    provider_port = free_port()
+    app_port = free_port()
+    provider_url = 'http://127.0.0.1:{}'.format(provider_port)
+    base = 'http://127.0.0.1:{}'.format(app_port)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            'client-id': 'bench-client',
+            'client-secret': 'bench-secret',
+            'session-secret': 'bench-session-secret',
+            'oidc-metadata-url': provider_url + '/.well-known/openid-configuration',
+            'session-db': os.path.join(tmp, 'sessions.db'),
+            'avatar-cache-dir': os.path.join(tmp, 'avatars'),
+            'template-cache-dir': os.path.join(tmp, 'jinja'),
+            'audit-path': os.path.join(
+                tmp, 'audit.jsonl' if os.environ.get('audit-sink') == 'jsonl' else 'audit.db'),
+        })
+        if args.workers > 1 and 'session-backend' not in os.environ:
+            # Logins bounce between workers, so sessions must be shared.
+            env['session-backend'] = 'sqlite'
+        provider = start_server('bench.fake_oidc:app', provider_port)
+        server = start_server('app.main:app', app_port, env, args.workers)
+        try:
+            wait_until_up(provider_url + '/_control', provider)
+            wait_until_up(base + '/', server)
+            scenarios = asyncio.run(drive(args, base))
+            rss = rss_by_process(server.pid)
+        finally:
+            for process in (server, provider):
+                process.terminate()
+            for process in (server, provider):
+                process.wait(timeout=30)
+
+    results = {
+        'config': {
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'workers': args.workers,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'scenarios': scenarios,
+        'rss_mib': rss,
+    }
+    report(results)
+
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(os.path.join(BASELINES, args.save + '.json'), 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(os.path.join(BASELINES, args.compare + '.json')) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
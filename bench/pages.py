@@ -0,0 +1,58 @@
+"""Anonymous ``GET /`` throughput with the page cache on and off.
+
+Calls the full app stack through ASGI in-process (no sockets), so the
+numbers are the server-side cost per request::
+
+    python -m bench.pages [requests]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.main import app, pages  # noqa: E402
+
+
+async def get(path, headers=()):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'root_path': '', 'query_string': b'', 'server': ('testserver', 80),
+        'client': ('127.0.0.1', 50000), 'headers': [(b'host', b'testserver'), *headers],
+    }
+    status = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+async def run(name, requests, headers=()):
+    assert await get('/', headers) in (200, 304)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await get('/', headers)
+    elapsed = time.perf_counter() - start
+    print('{:<16} {:>9.0f} req/s {:>8.1f} us/request'.format(
+        name, requests / elapsed, elapsed / requests * 1e6))
+
+
+async def main(requests=5000):
+    pages.enabled = False
+    await run('cache off', requests)
+    pages.enabled = True
+    await run('cache on', requests)
+    etag = pages._entries[next(iter(pages._entries))][2].encode('ascii')
+    await run('cache on, 304', requests, [(b'if-none-match', etag)])
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -0,0 +1,89 @@
+"""Per-request cost and cookie size of the session backends.
+
+Drives each middleware directly through ASGI (no sockets) with a typical
+Google ``userinfo`` payload in the session::
+
+    python -m bench.sessions
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from starlette.middleware.sessions import SessionMiddleware
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.sessions import MemoryStore, ServerSessionMiddleware, SQLiteStore  # noqa: E402
+
+SECRET = 'bench-secret'
+USER = {
+    'iss': 'https://accounts.google.com',
+    'azp': '684911749026-example.apps.googleusercontent.com',
+    'aud': '684911749026-example.apps.googleusercontent.com',
+    'sub': '110248495921238986420',
+    'email': 'someone@example.com',
+    'email_verified': True,
+    'at_hash': 'uN8cCbhMDAXb1X8-g7PMBQ',
+    'nonce': 'mTRuHkdXBPAB7GNvWIt4',
+    'name': 'Some Body',
+    'picture': 'https://lh3.googleusercontent.com/a/ACg8ocJ1x2y3z4-example=s96-c',
+    'given_name': 'Some',
+    'family_name': 'Body',
+    'locale': 'en',
+    'iat': 1700000000,
+    'exp': 1700003600,
+}
+
+
+async def endpoint(scope, receive, send):
+    session = scope['session']
+    if scope['path'] == '/login':
+        session['user'] = dict(USER)
+    else:
+        session.get('user')
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def call(app, path, cookie=None):
+    headers = [(b'cookie', cookie.encode('latin-1'))] if cookie else []
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'headers': headers}
+    set_cookie = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            for name, value in message['headers']:
+                if name == b'set-cookie':
+                    set_cookie.append(value.decode('latin-1'))
+
+    await app(scope, receive, send)
+    return set_cookie
+
+
+async def run(name, app, requests):
+    set_cookie = await call(app, '/login')
+    cookie = set_cookie[0].split(';', 1)[0]
+    start = time.perf_counter()
+    for _ in range(requests):
+        await call(app, '/welcome', cookie)
+    elapsed = time.perf_counter() - start
+    print('{:<8} {:>8.2f} us/request {:>6} byte cookie'.format(
+        name, elapsed / requests * 1e6, len(cookie)))
+
+
+async def main(requests=20000):
+    await run('cookie', SessionMiddleware(endpoint, secret_key=SECRET), requests)
+    await run('memory', ServerSessionMiddleware(endpoint, MemoryStore(), SECRET), requests)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteStore(os.path.join(tmp, 'sessions.db'))
+        await run('sqlite', ServerSessionMiddleware(endpoint, store, SECRET), requests)
+        store.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(*map(int, sys.argv[1:])))
@@ -1,9 +1,18 @@
+import sys
+
 import uvicorn
 
+from app import config
+
 if __name__ == "__main__":
+    if config.PRODUCTION:
+        from app.server import main
+        sys.exit(main())
+    for problem in config.problems():
+        print('WARNING:  Configuration: {}'.format(problem), file=sys.stderr)
     uvicorn.run(
         app =  'app.main:app',
-        host = 'localhost',
-        port = 8000 ,
+        host = config.SERVER_HOST,
+        port = config.SERVER_PORT ,
         reload= True 
     )
\ No newline at end of file
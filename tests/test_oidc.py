@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from authlib.integrations.starlette_client import OAuth, OAuthError
+from joserfc import jwt
+from joserfc.jwk import RSAKey
+
+from app.oidc import CachedOAuth2App, cache_ttl
+from bench import fake_oidc
+
+METADATA_URL = 'http://provider/.well-known/openid-configuration'
+
+
+class ProviderTransport(httpx.AsyncBaseTransport):
+    """Sends requests to the bundled fake provider, or fails them while ``down``."""
+
+    def __init__(self):
+        self.down = False
+        self._app = httpx.ASGITransport(app=fake_oidc.app)
+
+    async def handle_async_request(self, request):
+        if self.down:
+            raise httpx.ConnectError('provider is down', request=request)
+        return await self._app.handle_async_request(request)
+
+
+@pytest.fixture
+def transport():
+    fake_oidc.hits.clear()
+    return ProviderTransport()
+
+
+def make_client(transport, **kwargs):
+    oauth = OAuth()
+    return oauth.register(
+        name='provider',
+        client_cls=CachedOAuth2App,
+        server_metadata_url=METADATA_URL,
+        client_id='client',
+        client_secret='secret',
+        client_kwargs={'transport': transport},
+        **kwargs
+    )
+
+
+def test_concurrent_cold_misses_share_one_fetch(transport):
+    client = make_client(transport)
+
+    async def run():
+        return await asyncio.gather(*(client.load_server_metadata() for _ in range(20)))
+
+    results = asyncio.run(run())
+    assert all(result['jwks_uri'] == 'http://provider/jwks' for result in results)
+    assert fake_oidc.hits == {'discovery': 1}
+    assert client.metadata_cache.fetches == 1
+
+
+def test_ttl_comes_from_cache_control(transport):
+    client = make_client(transport, metadata_ttl=10)
+
+    async def run():
+        await client.load_server_metadata()
+        await client.load_server_metadata()
+
+    asyncio.run(run())
+    cache = client.metadata_cache
+    # The provider sends max-age=3600, which wins over the configured default.
+    assert cache.expires_at - cache.fetched_at == pytest.approx(3600)
+    assert fake_oidc.hits == {'discovery': 1}
+
+    assert cache_ttl({'cache-control': 'public, max-age=600', 'age': '100'}, 3600, 60, 86400) == 500
+    assert cache_ttl({'cache-control': 'no-cache'}, 3600, 60, 86400) == 60
+    assert cache_ttl({}, 3600, 60, 86400) == 3600
+
+
+def test_forced_jwks_refetch_is_rate_limited(transport):
+    client = make_client(transport)
+
+    async def run():
+        await client.fetch_jwk_set()
+        # Tokens signed with an unknown kid force a refetch every time.
+        for _ in range(5):
+            await client.fetch_jwk_set(force=True)
+        assert fake_oidc.hits['jwks'] == 2
+
+        client.jwks_cache.forced_at -= client.jwks_cache.min_force_interval
+        await client.fetch_jwk_set(force=True)
+        await client.fetch_jwk_set(force=True)
+
+    asyncio.run(run())
+    assert fake_oidc.hits['jwks'] == 3
+
+
+def id_token(key, kid):
+    now = int(time.time())
+    claims = {'iss': 'http://provider', 'aud': 'client', 'sub': '1', 'iat': now, 'exp': now + 60}
+    return jwt.encode({'alg': 'RS256', 'kid': kid}, claims, key)
+
+
+def test_key_rotated_right_after_a_refresh_is_picked_up(transport, monkeypatch):
+    client = make_client(transport)
+    rotated = RSAKey.generate_key(2048, parameters={'kid': 'rotated', 'use': 'sig', 'alg': 'RS256'})
+
+    async def run():
+        await client.warm_up()
+        await client.close()
+        monkeypatch.setattr(fake_oidc, 'KEY', rotated)
+        token = {'id_token': id_token(rotated, 'rotated'), 'access_token': 'at'}
+        return await client.parse_id_token(token, nonce=None)
+
+    userinfo = asyncio.run(run())
+    assert userinfo['sub'] == '1'
+    assert fake_oidc.hits['jwks'] == 2
+
+
+def test_unknown_kid_is_an_oauth_error(transport):
+    client = make_client(transport)
+    stranger = RSAKey.generate_key(2048, parameters={'kid': 'stranger'})
+    token = {'id_token': id_token(stranger, 'stranger'), 'access_token': 'at'}
+
+    async def run():
+        for _ in range(3):
+            with pytest.raises(OAuthError) as info:
+                await client.parse_id_token(token, nonce=None)
+            assert info.value.error == 'invalid_token'
+
+    asyncio.run(run())
+    assert fake_oidc.hits['jwks'] == 2
+
+
+def test_failed_refresh_serves_stale_copy(transport):
+    client = make_client(transport)
+
+    async def run():
+        first = await client.load_server_metadata()
+        transport.down = True
+        client.metadata_cache.expires_at = 0
+        stale = await client.load_server_metadata()
+        # The stale copy is kept for min_ttl instead of retrying on every call.
+        again = await client.load_server_metadata()
+        return first, stale, again
+
+    first, stale, again = asyncio.run(run())
+    assert stale == first and again == first
+    assert fake_oidc.hits == {'discovery': 1}
+    assert client.metadata_cache.fresh()
+
+
+def test_cold_miss_with_provider_down_raises(transport):
+    client = make_client(transport)
+    transport.down = True
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(client.load_server_metadata())
@@ -0,0 +1,157 @@
+import asyncio
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+from app.outbound import CircuitBreaker, GuardedTransport, ProviderUnavailable
+from bench import fake_oidc
+
+
+@pytest.fixture(scope='module')
+def provider_url():
+    """The fake provider behind a real socket, so timeouts and stalls are real."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        fake_oidc.app, host='127.0.0.1', port=port, log_level='warning', lifespan='off'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        assert time.monotonic() < deadline, 'fake provider did not start'
+        time.sleep(0.02)
+    yield 'http://127.0.0.1:{}'.format(port)
+    server.should_exit = True
+    thread.join(timeout=10)
+
+
+@pytest.fixture
+def provider(provider_url):
+    fake_oidc.hits.clear()
+    yield provider_url
+    fake_oidc.control.update(latency=0.0, error_rate=0.0, stall=0.0)
+
+
+def set_control(**values):
+    fake_oidc.control.update(values)
+
+
+async def post_token(client, provider):
+    return await client.post(provider + '/token', data={'code': 'unknown'})
+
+
+def make_client(transport, read_timeout=5.0):
+    return httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(read_timeout, connect=1.0))
+
+
+def test_opens_after_failures_and_fails_fast(provider):
+    async def run():
+        transport = GuardedTransport(breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60))
+        set_control(error_rate=1.0)
+        async with make_client(transport) as client:
+            for _ in range(3):
+                with pytest.raises(ProviderUnavailable):
+                    await post_token(client, provider)
+            assert transport.breaker.state == 'open'
+
+            set_control(error_rate=0.0)
+            start = time.monotonic()
+            with pytest.raises(ProviderUnavailable, match='circuit is open'):
+                await post_token(client, provider)
+            assert time.monotonic() - start < 0.1
+        await transport.close()
+
+    asyncio.run(run())
+    assert fake_oidc.hits['token'] == 3
+
+
+def test_half_open_lets_a_single_trial_through(provider):
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+        transport = GuardedTransport(breaker=breaker)
+        async with make_client(transport) as client:
+            set_control(error_rate=1.0)
+            with pytest.raises(ProviderUnavailable):
+                await post_token(client, provider)
+            await asyncio.sleep(0.15)
+            assert breaker.state == 'half-open'
+
+            set_control(error_rate=0.0, latency=0.2)
+            results = await asyncio.gather(
+                *(post_token(client, provider) for _ in range(3)), return_exceptions=True)
+            rejected = [r for r in results if isinstance(r, ProviderUnavailable)]
+            answered = [r for r in results if isinstance(r, httpx.Response)]
+            assert len(rejected) == 2 and len(answered) == 1
+            assert breaker.state == 'closed'
+        await transport.close()
+
+    asyncio.run(run())
+    assert fake_oidc.hits['token'] == 2
+
+
+def test_cancelled_trial_releases_breaker_and_slot(provider):
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+        transport = GuardedTransport(max_concurrency=1, queue_timeout=0.2, breaker=breaker)
+        async with make_client(transport) as client:
+            set_control(error_rate=1.0)
+            with pytest.raises(ProviderUnavailable):
+                await post_token(client, provider)
+            await asyncio.sleep(0.15)
+
+            set_control(error_rate=0.0, latency=1.0)
+            trial = asyncio.ensure_future(post_token(client, provider))
+            await asyncio.sleep(0.1)
+            trial.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await trial
+
+            # Neither the half-open trial nor the only slot may be lost.
+            set_control(latency=0.0)
+            response = await post_token(client, provider)
+            assert response.status_code == 400
+            assert breaker.state == 'closed'
+        await transport.close()
+
+    asyncio.run(run())
+
+
+def test_stalled_body_raises_provider_unavailable(provider):
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60)
+        transport = GuardedTransport(max_concurrency=1, queue_timeout=0.2, breaker=breaker)
+        async with make_client(transport, read_timeout=0.2) as client:
+            set_control(stall=1.0)
+            with pytest.raises(ProviderUnavailable):
+                await post_token(client, provider)
+            assert breaker.failures == 1
+
+            set_control(stall=0.0)
+            response = await post_token(client, provider)
+            assert response.status_code == 400
+        await transport.close()
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_counts_as_failure(provider):
+    async def run():
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60)
+        transport = GuardedTransport(max_concurrency=1, queue_timeout=0.1, breaker=breaker)
+        async with make_client(transport) as client:
+            set_control(latency=0.5)
+            first = asyncio.ensure_future(post_token(client, provider))
+            await asyncio.sleep(0.05)
+            with pytest.raises(ProviderUnavailable, match='pending'):
+                await post_token(client, provider)
+            assert breaker.failures == 1
+            assert (await first).status_code == 400
+        await transport.close()
+
+    asyncio.run(run())
+    assert fake_oidc.hits['token'] == 1